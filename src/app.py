@@ -1,8 +1,8 @@
 import streamlit as st
-from notion import NotionAPI  # type: ignore
+from notion import NotionAPI, irr  # type: ignore
 from datetime import date, timedelta
+import numpy as np
 import pandas as pd
-import numpy_financial as npf  # type: ignore
 import plotly.express as px
 # import time
 
@@ -34,14 +34,18 @@ def get_data(_notion):
 
 @st.experimental_memo()
 def get_sunburst_fig(df_pos, products, sel_date):
-    df = (df_pos.loc[pd.Timestamp(sel_date),
-                     ["Cantidad", "Valor"]].unstack(level=0)
-                                           .reset_index())
-    df["Desc"] = df["Producto"].replace(
-        products.set_index("ticker_yfinance")["Producto"]
-                .to_dict())
+    # Build the frame directly from the row of the selected date, with the
+    # tickers sorted and cash at the end (the order "Tipo" below relies on)
+    row = df_pos.loc[pd.Timestamp(sel_date)]
+    prods = sorted(row["Valor"].index.drop("Efectivo")) + ["Efectivo"]
+    df = pd.DataFrame({"Producto": prods,
+                       "Cantidad": row["Cantidad"].reindex(prods).to_numpy(),
+                       "Valor": row["Valor"].reindex(prods).to_numpy()})
+    ticker_to_desc = dict(zip(products["ticker_yfinance"], products["Producto"]))
+    df["Desc"] = [ticker_to_desc.get(ticker, ticker) for ticker in df["Producto"]]
     df["Tipo"] = ["Equity", "Bonds", "Equity", "Equity", "Cash"]
-    df["Valor_perc"] = round(df["Valor"] / df["Valor"].sum() * 100, 2)
+    val_a = df["Valor"].to_numpy()
+    df["Valor_perc"] = np.round(val_a / np.nansum(val_a) * 100, 2)
 
     fig = px.sunburst(df, path=["Tipo", "Producto"], values="Valor_perc",
                       title=f"Posición a {sel_date.strftime('%d/%m/%Y')}")
@@ -50,6 +54,14 @@ def get_sunburst_fig(df_pos, products, sel_date):
     return fig
 
 
+@st.experimental_memo()
+def get_rets(df_pos, df_perf):
+    # Daily returns (+1) of each product and the portfolio: only depend on the
+    # loaded data, the selected dates just slice them
+    return ((df_pos["Adj Close"].pct_change() + 1)
+            .join(df_perf["ROR_daily"].rename("Cartera")))
+
+
 st.title("Portfolio tracker")
 st.write("""Primer intento de crear algo *niiice*.""")
 
@@ -94,12 +106,11 @@ st.subheader("Resumen posiciones")
 # Important KPIs (3)
 col1, col2, col3, col4 = st.columns(4)
 
-# Portfolio value (and vs. Day-1)
-value_portfolio = df_pos.loc[pd.Timestamp(sel_date), "Valor"].sum()
-diff_1d_portfolio = (df_pos.loc[sel_date - timedelta(days=1):sel_date, "Valor"]
-                           .sum(axis=1).diff()[-1])
-pct_1d_portfolio = (df_pos.loc[sel_date - timedelta(days=1):sel_date, "Valor"]
-                          .sum(axis=1).pct_change()[-1] * 100)
+# Portfolio value (and vs. Day-1), all from a single slice of both days
+value_1d = df_pos.loc[sel_date - timedelta(days=1):sel_date, "Valor"].sum(axis=1)
+value_portfolio = value_1d.iloc[-1]
+diff_1d_portfolio = value_1d.diff().iloc[-1]
+pct_1d_portfolio = value_1d.pct_change().iloc[-1] * 100
 col1.metric("Valor cartera (vs día ant.)",
             f"{value_portfolio:.2f}€",
             f"{diff_1d_portfolio:.2f}€ ({pct_1d_portfolio:.2f}%)")
@@ -129,7 +140,7 @@ else:
     s_mwr[start_date] = - df_perf.loc[pd.Timestamp(start_date), "valor act."]
 s_mwr[sel_date] = (df_perf.loc[pd.Timestamp(sel_date), "valor act."]
                    - df_perf.loc[pd.Timestamp(sel_date), "movimientos"])
-mwr = ((npf.irr(s_mwr) + 1)**365 - 1) * 100
+mwr = ((irr(s_mwr.to_numpy()) + 1)**365 - 1) * 100
 col4.metric("MWR",
             f"{mwr:.2f}%")
 
@@ -156,10 +167,7 @@ col2.plotly_chart(sunburst_fig)
 # PART 3: Asset Performance
 st.subheader("Rendimiento")
 
-df_rets = (
-    (df_pos["Adj Close"].pct_change() + 1)
-    .join(df_perf["ROR_daily"].rename("Cartera"))
-)
+df_rets = get_rets(df_pos, df_perf)
 
 line_fig = px.line((df_rets.loc[start_date:sel_date].cumprod() - 1) * 100,
                    labels={"value": "Rendimiento (%)",
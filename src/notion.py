@@ -1,10 +1,21 @@
 # import config  # type: ignore
 from pathlib import Path
+import hashlib
+import json
+import os
+import pickle
+import tempfile
+import time
 import toml
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 from typing import Union
-from dateutil.parser import parse
+from dataclasses import dataclass, field, InitVar
 from datetime import date, timezone
+import numpy as np
 import pandas as pd
 import yfinance as yf
 import pandas_datareader.data as web
@@ -12,87 +23,485 @@ import pandas_datareader.data as web
 
 
 MARKETS_DICT = {"EAM": "AS", "XET": "DE", "MAD": "MC"}
+YF_COLUMNS = ["Adj Close", "Close", "High", "Low", "Open", "Volume"]
 
 # Configure from TOML file in folder secret for streamlit
 root_dir = Path(__file__).parents[1] 
 config_file = root_dir / ".streamlit/secrets.toml"
 config = toml.load(config_file)
 
+# Parsed API responses are cached on disk to survive Streamlit reruns/restarts
+CACHE_DIR = root_dir / ".cache"
+CACHE_TTL = 300  # seconds
+YF_CACHE_TTL = 3600  # seconds
+# Cached responses not refreshed for this long (e.g. pages of old query
+# cursors) are removed
+CACHE_MAX_AGE = 7 * 24 * 3600  # seconds
 
-class NotionAPI():
+
+def _replace_file(path: Path, write) -> None:
+    # Write to a temporary file next to `path` and move it into place, so that
+    # readers (or a crash mid-write) never leave a truncated cache file
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_name = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    os.close(fd)
+    try:
+        write(tmp_name)
+        os.replace(tmp_name, path)
+    except BaseException:
+        Path(tmp_name).unlink(missing_ok=True)
+        raise
+
+
+# Extraction of the cell value from each Notion property datatype
+def _rich_text(values: dict) -> Union[str, None]:
+    # Empty cell -> None
+    rich_text = values["rich_text"]
+    return rich_text[0]["plain_text"] if rich_text else None
+
+
+def _date(values: dict) -> str:
+    # Raw string, parsed afterwards for the whole column
+    return values["date"]["start"]
+
+
+def _select(values: dict) -> str:
+    return values["select"]["name"]
+
+
+def _number(values: dict) -> Union[float, None]:
+    return values["number"]
+
+
+# Handler for each database column (in output order)
+COL_HANDLERS = {
+    "Fecha": _date,
+    "Tipo": _select,
+    "Producto": _rich_text,
+    "ISIN": _rich_text,
+    "Bolsa": _rich_text,
+    "Centro ejecución": _rich_text,
+    "Símbolo": _rich_text,
+    "Descripción": _rich_text,
+    "Unidades": _number,
+    "Valor": _number,
+    "Tasa": _number,
+}
+
+
+def irr(cashflows, guess: float = 0.0, tol: float = 1e-9, maxiter: int = 50) -> float:
+    """
+    Internal Rate of Return of a series of evenly spaced cashflows.
+
+    Solves `sum(cf_t / (1 + r)**t) = 0` with Newton-Raphson using only the non-zero
+    cashflows (daily series are mostly zeros), so it scales linearly with the
+    number of movements instead of computing the roots of a polynomial of the
+    series length like `numpy_financial.irr`. Steps below -100 % are damped, and
+    if Newton doesn't converge the root nearest to 0 is bisected.
+
+    Parameters
+    ----------
+    ```python
+    cashflows : array_like
+    ```
+        Cashflows per period (negative for deposits, positive for withdrawals).
+    ```python
+    guess : float, default=0.0
+    ```
+        Initial rate for the iteration.
+    ```python
+    tol : float, default=1e-9
+    ```
+        Convergence tolerance on the rate step.
+    ```python
+    maxiter : int, default=50
+    ```
+        Maximum number of iterations.
+
+    Returns
+    -------
+    ```python
+    float
+    ```
+        Rate of return per period (NaN if there is no root above -100 %).
+    """
+
+    cf = np.asarray(cashflows, dtype=np.float64)
+    t = np.flatnonzero(cf)
+    cf = cf[t]
+    # Count periods from the first cashflow (same roots, and the NPV doesn't
+    # flatten out to 0 for large rates, where Newton would drift away)
+    t = (t - t[0] if len(t) else t).astype(np.float64)
+    rate = guess
+    with np.errstate(over="ignore", divide="ignore", invalid="ignore"):
+        for _ in range(maxiter):
+            discounted = cf * (1 + rate) ** -t
+            npv = discounted.sum()
+            d_npv = (-t * discounted).sum() / (1 + rate)
+            if d_npv == 0 or not np.isfinite(d_npv):
+                break
+            step = npv / d_npv
+            if rate - step <= -1:
+                # Overshoot below -100 %: go halfway towards -1 instead
+                rate = (rate - 1) / 2
+                continue
+            rate -= step
+            if abs(step) < tol:
+                return rate
+    # Newton can head the wrong way when the NPV isn't monotonic (e.g. several
+    # deposits before a loss): bisect a bracketed root instead
+    return _irr_bisect(cf, t, tol)
+
+
+def _irr_bisect(cf: np.ndarray, t: np.ndarray, tol: float) -> float:
+    # Look for sign changes of the NPV on a grid of log(1 + rate) (bounded so
+    # that the discount factors don't overflow) and bisect the one nearest to 0
+    if len(t) < 2:
+        return np.nan
+    g_max = min(10.0, 700.0 / t[-1])
+    g = np.linspace(-g_max, g_max, 401)
+    npv = np.exp(-np.outer(g, t)) @ cf
+    changes = np.flatnonzero(np.sign(npv[:-1]) != np.sign(npv[1:]))
+    if not len(changes):
+        return np.nan
+    i = changes[np.argmin(np.abs(g[changes] + g[changes + 1]))]
+    lo, hi, npv_lo = g[i], g[i + 1], npv[i]
+    while hi - lo > tol:
+        mid = (lo + hi) / 2
+        npv_mid = np.exp(-mid * t) @ cf
+        if np.sign(npv_mid) == np.sign(npv_lo):
+            lo, npv_lo = mid, npv_mid
+        else:
+            hi = mid
+    return np.expm1((lo + hi) / 2)
+
+
+@dataclass(eq=False)
+class NotionAPI:
     """
     A class to use Notion API and get data from Notion's databases.
 
+    Requests are sent through a persistent `requests.Session` so that the
+    underlying connection to Notion is kept alive between calls, and the parsed
+    responses are cached on disk for `cache_ttl` seconds.
+
+    Parameters
+    ----------
+    ```python
+    version : str, default=NOTION_VERSION
+    ```
+        The Notion API version needed in the CURL header.
+    ```python
+    token : str, default=secrets.INT_TOKEN
+    ```
+        The secret integration token provided by Notion API needed in
+        the CURL header. Keep it safe!
+    ```python
+    cache_dir : pathlib.Path, default=CACHE_DIR
+    ```
+        Folder where the parsed responses are cached.
+    ```python
+    cache_ttl : float, default=CACHE_TTL
+    ```
+        Seconds during which a cached response is served without revalidating
+        it against Notion.
+    ```python
+    yf_cache_ttl : float, default=YF_CACHE_TTL
+    ```
+        Seconds during which a cached *Yahoo! Finance* history is served without
+        downloading its latest days.
+
     Methods
     -------
     ```python
-    retrieve_db(token=secrets.INT_TOKEN, version=NOTION_VERSION)
+    retrieve_db(db_url=secrets.DB_URL, db_id=secrets.DB_ID)
     ```
         Retrieves whole database
     ```python
-    query_db(token=secrets.INT_TOKEN, version=NOTION_VERSION)
+    query_db(db_url=secrets.DB_URL, db_id=secrets.DB_ID, page_size=100)
     ```
-        Queries database to get specific results
+        Queries database to get specific results (all pages)
     """
 
-    def __init__(self):
-        pass
+    version: InitVar[str] = config["notion"]["VERSION"]
+    token: InitVar[str] = config["notion"]["INT_TOKEN"]
+    cache_dir: Path = CACHE_DIR
+    cache_ttl: float = CACHE_TTL
+    yf_cache_ttl: float = YF_CACHE_TTL
+    # Products found in the transactions (set by `get_transactions_df()`)
+    products: Union[pd.DataFrame, None] = field(default=None, init=False, repr=False)
+    # Database schemas already retrieved (by URL)
+    _schemas: dict = field(default_factory=dict, init=False, repr=False)
+    # Stock data last assembled (by tickers and dates) with its timestamp
+    _yf_cache: dict = field(default_factory=dict, init=False, repr=False)
+    _session: requests.Session = field(default_factory=requests.Session, init=False,
+                                       repr=False)
+    # Prefix of the cache keys, so that instances with other credentials or API
+    # version sharing `cache_dir` don't serve each other's responses
+    _cache_ns: str = field(default="", init=False, repr=False)
+
+    def __post_init__(self, version: str, token: str):
+        self.cache_dir = Path(self.cache_dir)
+        self._cache_ns = hashlib.sha1((token + version).encode()).hexdigest()
+        self._prune_cache()
+        self._session.headers.update({"Authorization": token,
+                                      "Notion-Version": version})
+        # Retry transient errors (and Notion's rate limiting) with backoff.
+        # Database queries are read-only, so POST is safe to retry too. Once the
+        # retries run out, the last response is returned (and `_request` raises
+        # its usual ConnectionError) instead of a urllib3 RetryError
+        retries = Retry(total=3, backoff_factor=0.3,
+                        status_forcelist=[429, 500, 502, 503, 504],
+                        allowed_methods=["GET", "POST"],
+                        raise_on_status=False)
+        self._session.mount("https://", HTTPAdapter(pool_connections=4,
+                                                    pool_maxsize=16,
+                                                    max_retries=retries))
+
+    def _prune_cache(self):
+        """
+        Removes the cached responses not refreshed in the last `CACHE_MAX_AGE` seconds.
+        """
+
+        expiry = time.time() - CACHE_MAX_AGE
+        # (along with temporary files left by an interrupted write)
+        for cache_file in [*self.cache_dir.glob("*.pkl"), *self.cache_dir.glob("*.tmp")]:
+            if cache_file.stat().st_mtime < expiry:
+                cache_file.unlink(missing_ok=True)
 
-    def retrieve_db(self,
-                    db_url: str = config["notion"]["DB_URL"],
-                    db_id: str = config["notion"]["DB_ID"],
-                    version: str = config["notion"]["VERSION"],
-                    token: str = config["notion"]["INT_TOKEN"]) -> dict:
+    def _request(self, method: str, url: str, body: Union[dict, None] = None) -> dict:
         """
-        Retrieves whole database using [Notion's API GET method](https://developers.notion.com/reference/retrieve-a-database/).
+        Sends a request to Notion's API caching the parsed response on disk.
+
+        Cache entries are keyed by credentials, method, URL and body. Fresh
+        entries (younger than `cache_ttl`) are returned without any request;
+        stale ones are revalidated sending their `ETag` in `If-None-Match`, so a
+        `304` response returns the cached object without downloading and
+        parsing it again.
 
         Parameters
         ----------
-        token : str, default=secrets.INT_TOKEN
-            The secret integration token provided by Notion API needed in
-            the CURL header. Keep it safe!
-        version : str, default=NOTION_VERSION
-            The Notion API version needed in the CURL header.
+        ```python
+        method : str
+        ```
+            HTTP method ("GET" or "POST").
+        ```python
+        url : str
+        ```
+            Endpoint URL.
+        ```python
+        body : dict, default=None
+        ```
+            JSON body of the request.
 
         Returns
         -------
-        json
-            The GET response from CURL in json format.
+        ```python
+        dict
+        ```
+            The parsed json response.
 
         Raises
         ------
+        ```python
         ConnectionError
-            If the response status from the CURL request is different from 200.
+        ```
+            If the response status is different from 200 (or 304 when revalidating).
         """
 
-        url = db_url + db_id
-        header = {"Authorization": token, "Notion-Version": version}
-        response = requests.get(url, headers=header)
-        if response.status_code == 200:
-            return response.json()
+        key = hashlib.sha1((self._cache_ns + method + url + json.dumps(body, sort_keys=True))
+                           .encode()).hexdigest()
+        cache_file = self.cache_dir / f"{key}.pkl"
+        cached = None
+        if cache_file.exists():
+            try:
+                cached = pickle.loads(cache_file.read_bytes())
+            except (EOFError, pickle.UnpicklingError):
+                # Unreadable entry: treated as a cache miss (and overwritten)
+                cached = None
+            if cached is not None and time.time() - cached["timestamp"] < self.cache_ttl:
+                return cached["data"]
+
+        headers = {}
+        if cached is not None and cached["etag"]:
+            headers["If-None-Match"] = cached["etag"]
+        response = self._session.request(method, url, json=body, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            data = cached["data"]
+        elif response.status_code == 200:
+            # orjson parses the deeply nested Notion payloads much faster
+            # than the stdlib json used by `response.json()`
+            data = orjson.loads(response.content)
         else:
             raise ConnectionError(f"Response status: {response.status_code}")
 
-    def query_db(self,
-                 db_url: str = config["notion"]["DB_URL"],
-                 db_id: str = config["notion"]["DB_ID"],
-                 version: str = config["notion"]["VERSION"],
-                 token: str = config["notion"]["INT_TOKEN"]) -> dict:
+        entry = pickle.dumps({"timestamp": time.time(),
+                              "etag": response.headers.get("ETag"),
+                              "data": data})
+        _replace_file(cache_file, lambda tmp_name: Path(tmp_name).write_bytes(entry))
+        return data
+
+    def _get_ticker_history(self, ticker: str, start: pd.Timestamp) -> pd.DataFrame:
         """
-        Queries database for specific results using [Notion's API POST method](https://developers.notion.com/reference/post-database-query).
+        Returns daily historic data of `ticker` from *Yahoo! Finance*, cached on disk.
+
+        The history is stored as a parquet file per ticker, along with the date it
+        was downloaded from. When it already covers `start`, it is returned as is
+        if it was refreshed less than `yf_cache_ttl` seconds ago, and otherwise
+        only the days from the last cached one onwards are downloaded (the last
+        one included, as it may have been saved before the close). An unreadable
+        file is downloaded again from `start`.
 
         Parameters
         ----------
-        token : str, default=secrets.INT_TOKEN
-            The secret integration token provided by Notion API needed in
-            the CURL header. Keep it safe!
-        version : str, default=NOTION_VERSION
-            The Notion API version needed in the CURL header.
+        ```python
+        ticker : str
+        ```
+            Ticker symbol compatible with yfinance.
+        ```python
+        start : pandas.Timestamp
+        ```
+            First date of the history.
+
+        Returns
+        -------
+        ```python
+        pandas.DataFrame
+        ```
+            The tz-naive daily history with `YF_COLUMNS` as columns (empty if
+            Yahoo! Finance has no data for the ticker).
+        """
+
+        cache_file = self.cache_dir / "yf" / f"{ticker}.parquet"
+        cached = None
+        if cache_file.exists():
+            try:
+                cached = pd.read_parquet(cache_file)
+            except (OSError, ValueError):
+                # Unreadable file (e.g. truncated): treated as a cache miss
+                cached = pd.DataFrame()
+            # The history covers `start` if it was downloaded from that date or
+            # before (its first row may be later: weekends, holidays, listing)
+            cached_start = (None if cached.empty else
+                            pd.Timestamp(cached.attrs.get("start", cached.index.min())))
+            if cached_start is None or cached_start > start:
+                cached = None
+            elif time.time() - cache_file.stat().st_mtime < self.yf_cache_ttl:
+                return cached.loc[start:]
+
+        fetch_start = start if cached is None else cached.index.max()
+        # Ticker.history (unlike yf.download) is safe to call from several threads
+        df_new = yf.Ticker(ticker).history(start=fetch_start, auto_adjust=False)
+        df_new = df_new.tz_localize(None).reindex(columns=YF_COLUMNS)
+
+        if cached is None:
+            df_hist = df_new
+        else:
+            df_hist = pd.concat([cached, df_new])
+            df_hist = df_hist[~df_hist.index.duplicated(keep="last")]
+        if not df_new.empty:
+            # Keep the date the history was downloaded from in the parquet metadata
+            df_hist.attrs["start"] = str(start if cached is None else cached_start)
+            _replace_file(cache_file,
+                          lambda tmp_name: df_hist.to_parquet(tmp_name, compression="zstd"))
+        elif cached is not None:
+            # Nothing new (e.g. weekend): still counts as refreshed
+            cache_file.touch()
+
+        return df_hist.loc[start:]
+
+    def _get_stock_df(self, tickers: list, date_idx: pd.DatetimeIndex,
+                      av_api_key: str) -> pd.DataFrame:
+        """
+        Returns the daily stock data of several tickers side by side.
+
+        Histories come from Yahoo! Finance (see `_get_ticker_history()`), and
+        the adjusted close of tickers without results there from Alpha Vantage.
+
+        Parameters
+        ----------
+        ```python
+        tickers : list
+        ```
+            Ticker symbols compatible with yfinance.
+        ```python
+        date_idx : pandas.DatetimeIndex
+        ```
+            Daily (tz-naive) index of the result.
+        ```python
+        av_api_key : str
+        ```
+            Alpha Vantage API key.
+
+        Returns
+        -------
+        ```python
+        pandas.DataFrame
+        ```
+            float32 stock data with (Métrica, Producto) columns.
+        """
+
+        # All tickers concurrently
+        with ThreadPoolExecutor(max_workers=max(1, min(16, len(tickers)))) as executor:
+            stock_frames = list(executor.map(
+                lambda ticker: self._get_ticker_history(ticker, date_idx[0]), tickers))
+        df_stock = (pd.concat(stock_frames, axis=1, keys=tickers, names=["Producto", "Métrica"])
+                      .swaplevel(axis=1).sort_index(axis=1))
+        # Put stock data on the (daily, tz-naive) date index (weekends and
+        # holidays are forward filled once, after completing the data)
+        df_stock = df_stock.reindex(date_idx)
+
+        # In case for some ticket yfinance doesn't return results (nothing on
+        # the first day, so it would still be missing after the ffill)
+        tickets_missing = df_stock["Adj Close"].iloc[0].isna()
+        tickets_missing = tickets_missing[tickets_missing].index.to_list()
+        if tickets_missing:
+            # Download data for all those tickets concurrently from Alpha Vantage
+            # using pandas_datareader (sharing a keep-alive session of its own)
+            with requests.Session() as av_session, \
+                    ThreadPoolExecutor(max_workers=min(8, len(tickets_missing))) as executor:
+                alt_frames = list(executor.map(
+                    lambda ticket: web.DataReader(ticket, "av-daily",
+                                                  start=date_idx[0],
+                                                  end=date.today(),
+                                                  api_key=av_api_key,
+                                                  session=av_session),
+                    tickets_missing))
+            # Put all alternative closes side by side on the daily index
+            alt_wide = pd.concat({ticket: alt_data["close"].set_axis(pd.to_datetime(alt_data.index))
+                                  for ticket, alt_data in zip(tickets_missing, alt_frames)},
+                                 axis=1).reindex(date_idx)
+            # Fill NaN with alternative data in one go
+            adj_close = df_stock["Adj Close"][tickets_missing].combine_first(alt_wide)
+            df_stock[[("Adj Close", ticket) for ticket in tickets_missing]] = \
+                adj_close[tickets_missing].to_numpy()
+        # Propagate last prices over weekends and holidays (single pass), in
+        # float32 like the quantities (halves the memory traffic below)
+        df_stock = df_stock.ffill().astype("float32", copy=False)
+
+        return df_stock
+
+    def retrieve_db(self,
+                    db_url: str = config["notion"]["DB_URL"],
+                    db_id: str = config["notion"]["DB_ID"]) -> dict:
+        """
+        Retrieves whole database using [Notion's API GET method](https://developers.notion.com/reference/retrieve-a-database/).
+
+        The schema rarely changes, so it is only requested once per instance
+        (and revalidated with its `ETag` by new instances once the disk cache
+        entry is stale).
+
+        Parameters
+        ----------
+        db_url : str, default=secrets.DB_URL
+            The base URL of Notion's databases endpoint.
+        db_id : str, default=secrets.DB_ID
+            The ID of the database to request.
 
         Returns
         -------
         json
-            The POST response from CURL in json format.
+            The GET response from CURL in json format.
 
         Raises
         ------
@@ -100,59 +509,78 @@ class NotionAPI():
             If the response status from the CURL request is different from 200.
         """
 
-        url = db_url + db_id + "/query"
-        header = {"Authorization": token, "Notion-Version": version}
-        response = requests.post(url, headers=header)
-        if response.status_code == 200:
-            return response.json()
-        else:
-            raise ConnectionError(f"Response status: {response.status_code}")
+        url = db_url + db_id
+        if url not in self._schemas:
+            self._schemas[url] = self._request("GET", url)
+        return self._schemas[url]
 
-    def _extract_plain_text(self, rich_text_object: list) -> Union[str, None]:
+    def query_db(self,
+                 db_url: str = config["notion"]["DB_URL"],
+                 db_id: str = config["notion"]["DB_ID"],
+                 page_size: int = 100) -> dict:
         """
-        From Notion's `rich_text` type get `plain_text` type
+        Queries database for specific results using [Notion's API POST method](https://developers.notion.com/reference/post-database-query).
 
-        3 cases are contemplated:
-            - Cell is empty: this translates in empty list in schema -> returns None
-            - Cell contains some text: list of 1 element in schema -> returns str
-            - ¿?: list of >1 element in schema -> raises Error
+        Notion returns at most `page_size` results per request, so the query
+        is repeated with the returned `next_cursor` until `has_more` is false.
 
         Parameters
         ----------
-        ```python
-        rich_text_object : list
-        ```
-            List containing Notion's `rich_text` type within `results` json schema
+        db_url : str, default=secrets.DB_URL
+            The base URL of Notion's databases endpoint.
+        db_id : str, default=secrets.DB_ID
+            The ID of the database to request.
+        page_size : int, default=100
+            Number of results requested per page (100 is Notion's maximum).
 
         Returns
         -------
-        ```python
-        str
-        ```
-            String object containing the cell plain text
+        json
+            The POST response from CURL in json format, with `results`
+            containing the entries from all pages.
 
         Raises
         ------
-        ```python
-        ValueError
-        ```
-            If object is empty or contains more than 1 element
+        ConnectionError
+            If the response status from the CURL request is different from 200.
         """
 
-        if not rich_text_object:
-            return None
-        elif len(rich_text_object) == 1:
-            return rich_text_object[0]["plain_text"]
-        else:
-            raise ValueError(f"More than 1 element in list!")
-
-    def get_transactions_df(self) -> pd.DataFrame:
+        url = db_url + db_id + "/query"
+        body = {"page_size": page_size}
+        data = None
+        while True:
+            page = self._request("POST", url, dict(body))
+            if data is None:
+                data = page
+            else:
+                data["results"].extend(page["results"])
+            if not page["has_more"]:
+                break
+            # Cursors are only known once the previous page arrives
+            body["start_cursor"] = page["next_cursor"]
+
+        data["has_more"] = False
+        data["next_cursor"] = None
+        return data
+
+    def get_transactions_df(self, markets_dict: dict = MARKETS_DICT) -> pd.DataFrame:
         """
         Returns `pandas.DataFrame` from Notion's database.
 
         Iterates through results from CURL response (following json schema)
         and applies appropiate format to each field depending on datatype.
 
+        Also stores in `self.products` the info of each product found, with its
+        ticker symbol compatible with yfinance (computed once here, not in every
+        call that needs it).
+
+        Parameters
+        ----------
+        ```python
+        markets_dict : dict, default=MARKETS_DICT
+        ```
+            Mapping from Notion's market codes to Yahoo! Finance ticker suffixes
+
         Returns
         -------
         ```python
@@ -162,85 +590,81 @@ class NotionAPI():
         """
 
         data = self.query_db()
-        records = []
+        # Build the table column by column (one list per field) in a single
+        # pass over the results, instead of one dict per row
+        cols = {col: [] for col in COL_HANDLERS}
         for entry in data["results"]:
-            record = {}
-            for col, values in entry["properties"].items():
-                # # TODO: wait for Streamlit to be compatible with Python 3.10
-                # # in order to use match-case statement
-                # match col:
-                #     case "Tipo":
-                #         record[col] = values["select"]["name"]
-                #     case "Descripción":
-                #         record[col] = self._extract_plain_text(values["rich_text"])
-                #     case "Valor":
-                #         record[col] = values["number"]
-                #     case "Fecha":
-                #         record[col] = datetime.strptime(values["date"]["start"],
-                #                                         "%Y-%m-%d").date()
-                #     case "Producto":
-                #         record[col] = self._extract_plain_text(values["rich_text"])
-                #     case "Unidades":
-                #         record[col] = values["number"]
-                #     case "Tasa":
-                #         record[col] = values["number"]
-                #     case "Símbolo":
-                #         record[col] = self._extract_plain_text(values["rich_text"])
-                #    # case _:
-                #    #     pass
-
-                # "rich_text" datatype
-                if col in ["Producto", "ISIN", "Bolsa", "Centro ejecución",
-                           "Símbolo", "Descripción"]:
-                    record[col] = self._extract_plain_text(values["rich_text"])
-                # "date" datatype
-                elif col == "Fecha":
-                    record[col] = parse(values["date"]["start"]).astimezone(timezone.utc)
-                # "select" datatype
-                elif col == "Tipo":
-                    record[col] = values["select"]["name"]
-                # "number" datatype
-                elif col in ["Unidades", "Valor", "Tasa"]:
-                    record[col] = values["number"]
-
-            records.append(record)
-
-        df = pd.DataFrame.from_records(records)
+            props = entry["properties"]
+            for col, handler in COL_HANDLERS.items():
+                cols[col].append(handler(props[col]))
+
+        # Rich text cells are expected to hold at most 1 element (checked in a
+        # separate pass, skipped when running with -O)
+        if __debug__:
+            for col, handler in COL_HANDLERS.items():
+                if handler is _rich_text and any(len(entry["properties"][col]["rich_text"]) > 1
+                                                 for entry in data["results"]):
+                    raise ValueError(f"More than 1 element in list of column {col}!")
+
+        # Explicit dtypes so pandas doesn't have to infer them (low-cardinality
+        # text as category, and float32 numbers: Notion sends few significant digits)
+        df = pd.DataFrame(cols, copy=False).astype(
+            {"Tipo": "category", "Producto": "category", "ISIN": "string",
+             "Bolsa": "category", "Centro ejecución": "category", "Símbolo": "string",
+             "Descripción": "string", "Unidades": "float32", "Valor": "float32",
+             "Tasa": "float32"}, copy=False)
+        # Repeated dates (several transactions per day) are parsed only once
+        df["Fecha"] = (pd.to_datetime(df["Fecha"], utc=True, format="ISO8601", cache=True)
+                         .dt.tz_convert(timezone.utc))
 
         # Create auxiliary columns for calculating Cash, Cumulative Deposits, Withdraws, etc.
         # df_tran_mod = df_tran.copy()
         # Order by ascending dates for computing cumulative values correctly
-        # df["Fecha"] = pd.to_datetime(df["Fecha"], format="%Y-%m-%d")
-        df = df.sort_values("Fecha")
-
-        df["Ingresado"] = abs(df.loc[df["Tipo"] == "Ingreso", "Valor"]
-                                .cumsum().reindex(df.index).fillna(method="ffill").fillna(0.0))
-        df["Retirado"] = abs(df.loc[df["Tipo"] == "Retirada", "Valor"]
-                               .cumsum().reindex(df.index).fillna(method="ffill").fillna(0.0))
-        df["Total"] = abs(df["Unidades"] * df["Valor"])
-        df["Comprado"] = abs(df.loc[df["Tipo"] == "Compra", "Total"]
-                               .cumsum().reindex(df.index).fillna(method="ffill").fillna(0.0))
-        df["Vendido"] = abs(df.loc[df["Tipo"] == "Venta", "Total"]
-                              .cumsum().reindex(df.index).fillna(method="ffill").fillna(0.0))
-        df["Dividendos acumulados"] = abs(df.loc[df["Tipo"] == "Dividendo", "Valor"]
-                                            .cumsum().reindex(df.index).fillna(method="ffill").fillna(0.0))
-        df["Costes acumulados"] = abs(df["Tasa"].cumsum().fillna(method="ffill").fillna(0.0))
-
-        df["Efectivo"] = (df[["Ingresado", "Dividendos acumulados", "Vendido"]].sum(axis=1) -
-                          df[["Retirado", "Comprado", "Costes acumulados"]].sum(axis=1))
+        # (in place, and stable so same-time transactions keep Notion's order)
+        df.sort_values("Fecha", kind="mergesort", ignore_index=True, inplace=True)
+
+        total = np.abs(df["Unidades"].to_numpy() * df["Valor"].to_numpy())
+        # Cumulative amount of each type of transaction (and of costs) in a single
+        # streaming pass: stack the contribution of every row to each metric
+        # (zero for the other types) and accumulate them all with one cumsum
+        # (in float64 so long histories don't drift, then stored as float32).
+        # Contributions are taken in absolute value beforehand (each type of
+        # transaction has a single sign), so the sums are already non-negative
+        valor = np.abs(df["Valor"].fillna(0.0).to_numpy())
+        metrics = [("Ingresado", "Ingreso", valor),
+                   ("Retirado", "Retirada", valor),
+                   ("Comprado", "Compra", np.nan_to_num(total)),
+                   ("Vendido", "Venta", np.nan_to_num(total)),
+                   ("Dividendos acumulados", "Dividendo", valor)]
+        contributions = np.column_stack(
+            [np.where((df["Tipo"] == tipo).to_numpy(), values, 0.0)
+             for _, tipo, values in metrics] +
+            [np.abs(df["Tasa"].fillna(0.0).to_numpy())])
+        cumulative = contributions.cumsum(axis=0, dtype=np.float64)
+        # New columns are appended already in their output order, so the frame
+        # can be returned as is (no final column selection copy)
+        cumulative_32 = cumulative.astype(np.float32)
+        df["Ingresado"], df["Retirado"] = cumulative_32[:, 0], cumulative_32[:, 1]
+        df["Total"] = total
+        df[["Comprado", "Vendido", "Dividendos acumulados", "Costes acumulados"]] = \
+            cumulative_32[:, 2:]
+
+        # Cash = Ingresado - Retirado - Comprado + Vendido + Dividendos - Costes,
+        # as a single pass over the cumulative matrix
+        df["Efectivo"] = (cumulative @ np.array([1.0, -1.0, -1.0, 1.0, 1.0, -1.0])
+                          ).astype(np.float32)
 
         # Get product info from transactions
-        self.products = (df[["Producto", "ISIN", "Bolsa",
-                             "Centro ejecución", "Símbolo"]].drop_duplicates()
-                                .dropna(subset=["Producto", "ISIN", "Símbolo"]))
+        products = (df[["Producto", "ISIN", "Bolsa",
+                        "Centro ejecución", "Símbolo"]].drop_duplicates()
+                           .dropna(subset=["Producto", "ISIN", "Símbolo"]))
+        # Create ticker symbol compatible with yfinance
+        self.products = products.assign(ticker_yfinance=products["Símbolo"].str.cat(
+            products["Bolsa"].astype("string").replace(markets_dict), sep="."))
 
-        return df[["Fecha", "Tipo", "Producto", "ISIN", "Bolsa", "Centro ejecución",
-                   "Símbolo", "Descripción", "Unidades", "Valor", "Tasa", "Ingresado",
-                   "Retirado", "Total", "Comprado", "Vendido", "Dividendos acumulados",
-                   "Costes acumulados", "Efectivo"]]
+        return df
 
     def get_his_positions_df(self, df_tran: pd.DataFrame, format_out: str = "wide",
-                             markets_dict: dict = MARKETS_DICT,
                              av_api_key: str = config["others"]["AV_API_KEY"]) -> pd.DataFrame:
         """
         Returns `pandas.DataFrame` with whole historic of open positions
@@ -270,73 +694,76 @@ class NotionAPI():
         """
 
         # Generate date index
-        date_idx = pd.date_range(df_tran["Fecha"].dt.date.min(), date.today(), name="Fecha")
+        date_idx = pd.date_range(df_tran["Fecha"].min().date(), date.today(), name="Fecha")
+
+        # Work on the needed columns only, without mutating the caller's frame
+        # (it may be a memoized object)
+        df_tran = df_tran[["Fecha", "Tipo", "Producto", "Unidades", "Efectivo"]].copy(deep=False)
+
+        # Invert "Sell" units sign (for those that are recorded as positive)
+        units = df_tran["Unidades"].to_numpy()
+        df_tran["Unidades"] = np.where((df_tran["Tipo"] == "Venta").to_numpy() & (units > 0),
+                                       -units, units)
+
+        # Add units traded into a dense (date_range x products) matrix at the row of
+        # their day and the column of their product: its cumsum is directly the open
+        # position of every day (no pivot, reindex or ffill needed)
+        df_bs = df_tran.loc[df_tran["Tipo"].isin(["Compra", "Venta"]) &
+                            df_tran["Producto"].notna(), ["Fecha", "Producto", "Unidades"]]
+        row_idx = date_idx.searchsorted(df_bs["Fecha"].dt.tz_convert(None).dt.normalize())
+        col_idx, prods = pd.factorize(df_bs["Producto"], sort=True)
+        traded = df_bs["Unidades"].fillna(0.0).to_numpy(dtype=np.float32)
+        # Trades dated after today (e.g. future-dated entries) fall outside the
+        # matrix: they are left out (their product keeps an all-NaN column)
+        in_range = row_idx < len(date_idx)
+        row_idx, col_idx, traded = row_idx[in_range], col_idx[in_range], traded[in_range]
+        qty = np.zeros((len(date_idx), len(prods)), dtype=np.float32)
+        np.add.at(qty, (row_idx, col_idx), traded)
+        qty = qty.cumsum(axis=0)
+        # No position (NaN) before the first trade of each product
+        first_row = np.full(len(prods), len(date_idx))
+        np.minimum.at(first_row, col_idx, row_idx)
+        qty[np.arange(len(date_idx))[:, None] < first_row] = np.nan
+        df_qty = pd.DataFrame(qty, index=date_idx, columns=pd.Index(prods, name="Producto"))
 
-        # Invert "Buy" units sign (for those that are recorded as positive)
-        df_tran.loc[(df_tran["Tipo"] == "Venta") & (df_tran["Unidades"] > 0),
-                    "Unidades"] *= -1
-
-        # Pivot transactions dataframe to get as index the date_range and the products
-        # as columns, propagating last valid observations (getting last timestamp record
-        # from each day)
-        df_qty = df_tran.loc[df_tran["Tipo"].isin(["Compra", "Venta"])] \
-            .pivot(index="Fecha", columns="Producto", values="Unidades") \
-                .sort_index().cumsum().fillna(method="ffill")
-        df_qty = df_qty.groupby(df_qty.index.date).tail(1)
-        df_qty = df_qty.set_index(df_qty.index.date).reindex(date_idx).fillna(method="ffill")
-
-        # Create ticker symbol compatible with yfinance
-        self.products["ticker_yfinance"] = (self.products["Símbolo"] + "." +
-                                            self.products["Bolsa"].replace(markets_dict))
         # Create MultiIndex with renamed columns to YFinance compatible tickets
         prod_col_level = df_qty.rename(columns=self.products.set_index("Producto")["ticker_yfinance"]
                                                             .to_dict()).columns
         df_qty.columns = pd.MultiIndex.from_product([["Cantidad"], prod_col_level],
                                                     names=["Métrica", "Producto"])
 
-        # Download whole historic series for all products from Yahoo! Finance
-        df_stock = yf.download(self.products["ticker_yfinance"].to_list(),
-                               df_tran["Fecha"].min())
-        # Convert from tz-aware to tz-naive DateTimeIndex
-        df_stock = df_stock.tz_localize(None).asfreq("D")
-        # From datetime to date index (to be able to join later)
-        df_stock = df_stock.set_index(df_stock.index.date)
-
-        # Join the Quantity dataframe (with open positions) with the
-        # stock data dataframe
-        df_wide = df_qty.join(df_stock, how="left").fillna(method="ffill")
-
-        # In case for some ticket yfinance doesn't return results
-        tickets_missing = df_wide["Adj Close"].isna().any()
-        for miss_ticket in tickets_missing[tickets_missing].index:
-            # Download data for ticket from Alpha Vantage
-            # using pandas_datareader
-            alt_data = web.DataReader(miss_ticket, "av-daily",
-                                      start=df_tran["Fecha"].dt.date.min(),
-                                      end=date.today(),
-                                      api_key=av_api_key)
-            # Convert index to DatetimeIndex
-            alt_data.index = pd.to_datetime(alt_data.index)
-            # Fill NaN with alternative data
-            (df_wide.loc[:, ("Adj Close", miss_ticket)]
-                    .fillna(alt_data["close"], inplace=True))
-            # Fill weekends with ffill
-            (df_wide.loc[:, ("Adj Close", miss_ticket)]
-                    .fillna(method="ffill", inplace=True))
-
-        # Create column with value of position
-        # (df_wide[["Cantidad"]] * df_wide["Adj Close"]).rename(columns={"Cantidad": "Valor"})
-        df_wide = df_wide.join(df_wide[["Cantidad"]].multiply(df_wide["Adj Close"])
-                                                    .rename(columns={"Cantidad": "Valor"}))
+        # Get whole historic series for all products from Yahoo! Finance (cached on
+        # disk, only the missing days are downloaded). Within the cache TTL, the
+        # same tickers and dates reuse the data already assembled in memory
+        tickers = self.products["ticker_yfinance"].to_list()
+        yf_key = (tuple(sorted(tickers)), date_idx[0], date_idx[-1])
+        cached = self._yf_cache.get(yf_key)
+        if cached is not None and time.time() - cached[0] < self.yf_cache_ttl:
+            df_stock = cached[1]
+        else:
+            df_stock = self._get_stock_df(tickers, date_idx, av_api_key)
+            # Only the latest entry is kept (the key changes every day, so a
+            # long-lived instance would otherwise pile up one frame per day)
+            self._yf_cache = {yf_key: (time.time(), df_stock)}
+
+        # Compute value of positions directly on the arrays (same ticker order as
+        # quantities) and assemble the wide dataframe in a single concat
+        prod_cols = df_qty.columns.get_level_values("Producto")
+        val_a = (df_qty.to_numpy() *
+                 df_stock["Adj Close"].reindex(columns=prod_cols).to_numpy())
+        df_val = pd.DataFrame(val_a, index=date_idx,
+                              columns=pd.MultiIndex.from_product([["Valor"], prod_cols],
+                                                                 names=["Métrica", "Producto"]))
+        df_wide = pd.concat([df_qty, df_stock, df_val], axis=1)
 
         # Add column for Cash just in Value part
         # df_wide["Valor", "Efectivo"] = (df_tran.drop_duplicates("Fecha", keep="last")
         #                                        .set_index("Fecha")["Efectivo"]
-        #                                        .reindex(df_wide.index).fillna(method="ffill"))
-        df_wide["Valor", "Efectivo"] = (df_tran.set_index(df_tran["Fecha"].dt.date)["Efectivo"]
+        #                                        .reindex(df_wide.index).ffill())
+        df_wide["Valor", "Efectivo"] = (df_tran.set_index(df_tran["Fecha"].dt.tz_convert(None)
+                                                                         .dt.normalize())["Efectivo"]
                                                 .groupby("Fecha").tail(1)
-                                                .reindex(df_wide.index).fillna(method="ffill"))
-                                               
+                                                .reindex(df_wide.index, method="ffill"))
 
         if format_out == "wide":
             return df_wide
@@ -359,14 +786,15 @@ class NotionAPI():
         (Time-Weighted Return and Money-Weighted Return)
         """
 
-        # Create pandas.Series with movement info (Ingresos-Retiradas)
-        s_mov = (df_tran.loc[df_tran["Tipo"].isin(["Ingreso", "Retirada"]),
+        # Create pandas.Series with movement info (Ingresos-Retiradas), signing
+        # each movement and summing them by day (same tz-naive days as df_pos)
+        df_mov = df_tran.loc[df_tran["Tipo"].isin(["Ingreso", "Retirada"]),
                              ["Fecha", "Tipo", "Valor"]]
-                        .groupby("Fecha")
-                        .apply(lambda x:
-                               x.loc[x["Tipo"] == "Ingreso", "Valor"].sum() -
-                               x.loc[x["Tipo"] == "Retirada", "Valor"].sum())
-                        .rename("movimientos"))
+        sign = np.where((df_mov["Tipo"] == "Ingreso").to_numpy(), 1.0, -1.0)
+        s_mov = (pd.Series(df_mov["Valor"].to_numpy() * sign,
+                           index=df_mov["Fecha"].dt.tz_convert(None).dt.normalize())
+                   .groupby(level=0).sum()
+                   .rename("movimientos"))
         # Create pandas.Series with current and previous value at same row level
         s_val_act = df_pos["Valor"].sum(axis=1).rename("valor act.")
         s_val_ant = df_pos["Valor"].sum(axis=1).shift().rename("valor ant.")
@@ -1,12 +1,16 @@
+import json
+import os
+import time
 import pytest
-from notion import NotionAPI
+from notion import NotionAPI, irr, CACHE_MAX_AGE
 from datetime import date, timezone
+import numpy as np
 import pandas as pd
 
 
 @pytest.fixture
-def notion():
-    return NotionAPI()
+def notion(tmp_path):
+    return NotionAPI(cache_dir=tmp_path)
 
 @pytest.fixture
 def df_tran(notion):
@@ -18,15 +22,198 @@ def df_qty(df_tran):
 
     df_qty = df_tran.loc[df_tran["Tipo"].isin(["Compra", "Venta"])] \
         .pivot(index="Fecha", columns="Producto", values="Unidades") \
-        .sort_index().cumsum().fillna(method="ffill")
+        .sort_index().cumsum().ffill()
     df_qty = df_qty.groupby(df_qty.index.date).tail(1)
-    df_qty = df_qty.set_index(df_qty.index.date).reindex(date_idx).fillna(method="ffill")
+    df_qty = df_qty.set_index(df_qty.index.date).reindex(date_idx).ffill()
 
     return df_qty 
 
+class FakeResponse:
+    """Stand-in for the `requests.Response` of a Notion API call"""
+
+    def __init__(self, payload, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = json.dumps(payload).encode()
+
 def test_query_db_not_empty(notion):
     assert bool(notion.query_db())
 
+def test_query_db_follows_pagination(notion, monkeypatch):
+    pages = {
+        None: {"results": [1, 2], "has_more": True, "next_cursor": "a"},
+        "a": {"results": [3], "has_more": True, "next_cursor": "b"},
+        "b": {"results": [4], "has_more": False, "next_cursor": None},
+    }
+    cursors = []
+
+    def fake_request(method, url, json, headers):
+        cursors.append(json.get("start_cursor"))
+        return FakeResponse(pages[json.get("start_cursor")])
+
+    monkeypatch.setattr(notion._session, "request", fake_request)
+    data = notion.query_db()
+    assert cursors == [None, "a", "b"]
+    assert data["results"] == [1, 2, 3, 4]
+    assert not data["has_more"]
+
+def test_retrieve_db_revalidates_with_etag(tmp_path, monkeypatch):
+    sent_headers = []
+
+    def fake_request(method, url, json, headers):
+        sent_headers.append(headers)
+        return FakeResponse({"object": "database"}, headers={"ETag": "v1"},
+                            status_code=304 if "If-None-Match" in headers else 200)
+
+    for _ in range(2):
+        notion = NotionAPI(cache_dir=tmp_path, cache_ttl=0)
+        monkeypatch.setattr(notion._session, "request", fake_request)
+        assert notion.retrieve_db() == {"object": "database"}
+        # Already retrieved by this instance: no request at all
+        assert notion.retrieve_db() == {"object": "database"}
+    assert sent_headers == [{}, {"If-None-Match": "v1"}]
+
+def test_request_cache_is_per_credentials(tmp_path, monkeypatch):
+    tokens = []
+
+    for token in ["token_a", "token_b", "token_a"]:
+        notion = NotionAPI(token=token, cache_dir=tmp_path)
+
+        def fake_request(method, url, json, headers, token=token):
+            tokens.append(token)
+            return FakeResponse({"object": "database"})
+
+        monkeypatch.setattr(notion._session, "request", fake_request)
+        assert notion.retrieve_db() == {"object": "database"}
+    # The second instance with "token_a" is served from the cache
+    assert tokens == ["token_a", "token_b"]
+
+def test_unreadable_cache_entry_is_a_miss(tmp_path, monkeypatch):
+    requests_sent = []
+
+    def fake_request(method, url, json, headers):
+        requests_sent.append(headers)
+        return FakeResponse({"object": "database"})
+
+    notion = NotionAPI(cache_dir=tmp_path)
+    monkeypatch.setattr(notion._session, "request", fake_request)
+    notion.retrieve_db()
+    # Truncated entry (e.g. interrupted write)
+    for cache_file in tmp_path.glob("*.pkl"):
+        cache_file.write_bytes(cache_file.read_bytes()[:10])
+
+    notion = NotionAPI(cache_dir=tmp_path)
+    monkeypatch.setattr(notion._session, "request", fake_request)
+    assert notion.retrieve_db() == {"object": "database"}
+    assert len(requests_sent) == 2
+    assert not list(tmp_path.glob("*.tmp"))
+
+def test_old_cache_entries_are_pruned(tmp_path):
+    old_file, new_file = tmp_path / "old.pkl", tmp_path / "new.pkl"
+    old_file.touch()
+    new_file.touch()
+    old_mtime = time.time() - CACHE_MAX_AGE - 1
+    os.utime(old_file, (old_mtime, old_mtime))
+    NotionAPI(cache_dir=tmp_path)
+    assert not old_file.exists()
+    assert new_file.exists()
+
+class FakeTicker:
+    """Stand-in for `yfinance.Ticker` returning business days from `start` to 2022-01-21"""
+    calls = []
+
+    def __init__(self, ticker):
+        self.ticker = ticker
+
+    def history(self, start, **kwargs):
+        FakeTicker.calls.append((self.ticker, pd.Timestamp(start)))
+        index = pd.bdate_range(start, "2022-01-21", tz="Europe/Madrid", name="Date")
+        return pd.DataFrame({"Close": 1.0, "Adj Close": 1.0}, index=index)
+
+@pytest.fixture
+def fake_ticker(monkeypatch):
+    FakeTicker.calls = []
+    monkeypatch.setattr("notion.yf.Ticker", FakeTicker)
+    return FakeTicker
+
+def test_ticker_history_cached_from_weekend_start(tmp_path, fake_ticker):
+    # First transaction on a Saturday: the history's first row is the Monday after
+    start = pd.Timestamp("2022-01-08")
+    first = NotionAPI(cache_dir=tmp_path)._get_ticker_history("IBE.MC", start)
+    second = NotionAPI(cache_dir=tmp_path)._get_ticker_history("IBE.MC", start)
+    assert fake_ticker.calls == [("IBE.MC", start)]
+    assert first.index[0] == pd.Timestamp("2022-01-10")
+    pd.testing.assert_frame_equal(first, second, check_freq=False)
+
+def test_ticker_history_downloads_only_new_days(tmp_path, fake_ticker):
+    start = pd.Timestamp("2022-01-08")
+    NotionAPI(cache_dir=tmp_path)._get_ticker_history("IBE.MC", start)
+    history = NotionAPI(cache_dir=tmp_path, yf_cache_ttl=0)._get_ticker_history("IBE.MC", start)
+    # Stale cache: only refreshed from its last (maybe incomplete) day
+    assert fake_ticker.calls == [("IBE.MC", start), ("IBE.MC", pd.Timestamp("2022-01-21"))]
+    assert history.index.is_unique and len(history) == 10
+
+def test_ticker_history_unreadable_file_is_downloaded_again(tmp_path, fake_ticker):
+    start = pd.Timestamp("2022-01-10")
+    cache_file = tmp_path / "yf" / "IBE.MC.parquet"
+    cache_file.parent.mkdir()
+    cache_file.write_bytes(b"PAR1 truncated")
+    history = NotionAPI(cache_dir=tmp_path)._get_ticker_history("IBE.MC", start)
+    assert fake_ticker.calls == [("IBE.MC", start)]
+    pd.testing.assert_frame_equal(pd.read_parquet(cache_file), history, check_freq=False)
+    assert not list(cache_file.parent.glob("*.tmp"))
+
+@pytest.fixture
+def offline_notion(tmp_path, fake_ticker):
+    notion = NotionAPI(cache_dir=tmp_path)
+    notion.products = pd.DataFrame({"Producto": ["Iberdrola S.A."],
+                                    "ticker_yfinance": ["IBE.MC"]})
+    return notion
+
+def test_his_positions_ignore_future_trades(offline_notion):
+    future = pd.Timestamp.now(tz="UTC") + pd.Timedelta(days=30)
+    df_tran = pd.DataFrame({
+        "Fecha": pd.to_datetime(["2022-01-10 09:00", "2022-01-11 10:00"], utc=True)
+                   .append(pd.DatetimeIndex([future])),
+        "Tipo": ["Ingreso", "Compra", "Compra"],
+        "Producto": [None, "Iberdrola S.A.", "Iberdrola S.A."],
+        "Unidades": [np.nan, 10.0, 5.0],
+        "Efectivo": [100.0, 90.0, 85.0]})
+    df_pos = offline_notion.get_his_positions_df(df_tran)
+    assert df_pos.index[-1] == pd.Timestamp(date.today())
+    assert df_pos["Cantidad", "IBE.MC"].iloc[-1] == 10.0
+
+def test_his_positions_reuse_stock_data_in_memory(offline_notion, fake_ticker):
+    df_tran = pd.DataFrame({
+        "Fecha": pd.to_datetime(["2022-01-10 09:00", "2022-01-11 10:00"], utc=True),
+        "Tipo": ["Ingreso", "Compra"],
+        "Producto": [None, "Iberdrola S.A."],
+        "Unidades": [np.nan, 10.0],
+        "Efectivo": [100.0, 90.0]})
+    first = offline_notion.get_his_positions_df(df_tran)
+    # Remove the disk cache too: the data must come from memory
+    for cache_file in (offline_notion.cache_dir / "yf").glob("*.parquet"):
+        cache_file.unlink()
+    second = offline_notion.get_his_positions_df(df_tran)
+    assert len(fake_ticker.calls) == 1
+    pd.testing.assert_frame_equal(first, second)
+    # Other dates replace the cached entry instead of adding one
+    offline_notion.get_his_positions_df(df_tran.iloc[1:])
+    assert len(offline_notion._yf_cache) == 1
+
+@pytest.mark.parametrize("cashflows, expected", [
+    ([-100.0, 110.0], 0.1),
+    ([-100.0, 0.0, 121.0], 0.1),
+    ([-1000.0] + [0.0] * 364 + [1100.0], 1.1 ** (1 / 365) - 1),
+    ([-100.0, 0.0, -50.0, 0.0, 0.0, 160.0], 0.01498202),
+    ([-1000.0, 450.0], -0.55),
+    ([-1000.0, 0.0, 0.0, 300.0], 0.3 ** (1 / 3) - 1),
+    ([0.0, -68.0] + [0.0] * 20 + [-342.8] + [0.0] * 7 + [185.2], -0.07815195),
+    ([-100.0, -50.0], np.nan),
+])
+def test_irr(cashflows, expected):
+    assert np.isclose(irr(cashflows), expected, equal_nan=True)
+
 def test_df_tran_dates_are_utc(df_tran):
     assert df_tran["Fecha"].dt.tz is timezone.utc
 